@@ -8,8 +8,9 @@ from sklearn.linear_model import RidgeClassifierCV, RidgeCV
 from sklearn.preprocessing import StandardScaler
 
 from .rmn import MemoryCell, NonLinearCell
+from .numba_kernels import NUMBA_AVAILABLE
 
-from typing import Callable
+from typing import Callable, Iterator
 
 
 class DeepReservoirMemoryNetwork(torch.nn.Module):
@@ -17,6 +18,9 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
     Deep Reservoir Memory Network.
     """
 
+    # number of batches run eagerly before capturing the forward pass in a CUDA graph
+    CUDA_GRAPH_WARMUP_BATCHES = 2
+
     def __init__(self,
                  task: str,
                  input_units: int,
@@ -58,9 +62,14 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
                  legendre: bool = False,
                  legendre_input: bool = False,
                  theta: float = 1.0,
+                 parallel_memory_scan: bool = False,
                  just_memory: bool = False,
                  input_to_all_non_linear: bool = False,
                  input_to_all_memory: bool = False,
+                 compute_dtype: torch.dtype = torch.float32,
+                 numba_threshold: int = 65536,
+                 gpu_ridge: bool = False,
+                 cuda_graph: bool = False,
                  ) -> None:
         """
         Initializes the Deep Reservoir Memory Network.
@@ -105,7 +114,21 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
         :param tolerance: Tolerance for the readout layer.
         :param legendre: Whether to use Legendre memory kernel.
         :param theta: Legendre memory kernel parameter.
+        :param parallel_memory_scan: Whether to compute the memory states with a parallel prefix scan over time
+        instead of a sequential loop. It is faster on GPU for long sequences.
         :param just_memory: Whether to use only the memory layers.
+        :param compute_dtype: Data type of the matrix products of the non-linear layers, e.g., torch.bfloat16 on
+        Ampere or newer GPUs. The states, the memory layers, and the readout are always computed in float32.
+        :param numba_threshold: On CPU, the recurrence of a layer runs with a compiled Numba kernel, if Numba is
+        installed, when batch_size * units is below this threshold. Sparse recurrent kernels are visited in CSR format
+        by the Numba kernel. Set it to 0 to always use PyTorch. Numba is an optional dependency.
+        :param gpu_ridge: Whether to fit the readout on the device where the states are computed, accumulating the
+        Gram matrix batch by batch instead of moving the states to the host. The regularization strength is selected
+        by generalized cross-validation. Just for regression.
+        :param cuda_graph: Whether to capture the forward pass of a batch in a CUDA graph and replay it for the
+        following batches, removing the Python and kernel launch overhead. Just on CUDA devices. The capture is
+        thread local, so that DataLoaders with pin_memory=True, whose pinning thread keeps allocating pinned memory
+        during the capture, are supported.
         """
 
         super().__init__()
@@ -113,10 +136,16 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
             alphas = [1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, 10, 100]
         if not isinstance(alphas, list):
             raise ValueError('Invalid alphas.')
+        if gpu_ridge and task != 'regression':
+            raise ValueError('The readout can be fitted on the device just for regression.')
         self._total_non_linear_units = total_non_linear_units
         self._total_memory_units = total_memory_units
         self._initial_transients = initial_transients
         self._just_memory = just_memory
+        self._compute_dtype = compute_dtype
+        self._numba_threshold = numba_threshold
+        self._gpu_ridge = gpu_ridge
+        self._cuda_graph = cuda_graph
         self._scaler = None
         self._concatenate_non_linear = concatenate_non_linear
         self._concatenate_memory = concatenate_memory
@@ -152,7 +181,8 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
                        fixed_input_kernel=fixed_input_kernel,
                        legendre=legendre,
                        legendre_input=legendre_input,
-                       theta=theta)
+                       theta=theta,
+                       parallel_scan=parallel_memory_scan)
         ]
         if concatenate_memory:
             last_h_memory_size = self._memory_units + total_memory_units % number_of_memory_layers
@@ -170,7 +200,8 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
                            fixed_input_kernel=fixed_input_kernel,
                            legendre=legendre,
                            legendre_input=legendre_input,
-                           theta=theta)
+                           theta=theta,
+                           parallel_scan=parallel_memory_scan)
             )
             last_h_memory_size = memory_layers[-1].memory_kernel.shape[0]
         self.memory_layers = torch.nn.ModuleList(memory_layers)
@@ -199,7 +230,8 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
                               circular_non_linear_kernel=circular_non_linear_kernel,
                               euler=euler,
                               epsilon=epsilon,
-                              gamma=gamma)
+                              gamma=gamma,
+                              compute_dtype=compute_dtype)
             ]
             if concatenate_non_linear:
                 last_h_non_linear_size = self._non_linear_units + total_non_linear_units % number_of_non_linear_layers
@@ -228,7 +260,8 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
                                   circular_non_linear_kernel=circular_non_linear_kernel,
                                   euler=euler,
                                   epsilon=epsilon,
-                                  gamma=gamma)
+                                  gamma=gamma,
+                                  compute_dtype=compute_dtype)
                 )
                 last_h_non_linear_size = non_linear_layers[-1].non_linear_kernel.shape[0]
             self.non_linear_layers = torch.nn.ModuleList(non_linear_layers)
@@ -238,174 +271,428 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
         elif task == 'regression':
             self.readout = RidgeCV(alphas=alphas)
         self._trained = False
-        self._memory_states = None
-        self._non_linear_states = None
+        # state buffers of the layers, reused across consecutive calls with the same batch size, sequence length,
+        # and device, and the key they were allocated for
+        self._buffers_key = None
+        self._memory_buffers = None
+        self._non_linear_buffers = None
+        # per-layer forward functions with the input, memory, and buffer choices bound, set by _reset_state
+        self._memory_layer_fns = None
+        self._non_linear_layer_fns = None
         self._concatenate_memory_input = [input_to_all_memory and idx > 0 for idx in range(number_of_memory_layers)]
         self._concatenate_non_linear_input = [input_to_all_non_linear and idx > 0
                                               for idx in range(number_of_non_linear_layers)]
 
-    def _reset_state(self, batch_size: int, seq_len, device: torch.device) -> None:
+    def _reset_state(self, batch_size: int, seq_len: int, device: torch.device, use_last_state: bool) -> None:
         """
-        Resets the internal state of the reservoir.
+        Resets the internal state of the reservoir and selects the buffers where the layers store their states.
+        The buffers of the last call are kept, so that they are allocated again just when the batch size, sequence
+        length, or device change. Only one set of buffers is kept alive at a time.
+        They are fully overwritten at each forward pass, hence they do not need to be zeroed.
 
         :param batch_size: The batch size.
+        :param seq_len: The sequence length.
         :param device: The device to perform computations on.
+        :param use_last_state: Whether just the states at the last time step are used.
         """
 
+        # small batches and layers are dominated by the PyTorch per step overhead, hence they run with Numba on CPU
+        numba = NUMBA_AVAILABLE and torch.device(device).type == 'cpu'
         for memory_layer in self.memory_layers:
-            memory_layer.reset_state(batch_size, device)
+            memory_layer.reset_state(batch_size, device, numba and not memory_layer._parallel_scan and
+                                     batch_size * memory_layer.memory_kernel.shape[0] < self._numba_threshold)
         if not self._just_memory:
             for non_linear_layer in self.non_linear_layers:
-                non_linear_layer.reset_state(batch_size, device)
-
-        # Pre-allocate non_linear_states and memory_states
-        if not self._just_memory:
-            self._non_linear_states = [
-                torch.empty((batch_size, seq_len, layer.non_linear_kernel.shape[0]),
-                            device=device, requires_grad=False, dtype=torch.float32)
-                for layer in self.non_linear_layers
+                non_linear_layer.reset_state(batch_size, device, numba and self._compute_dtype == torch.float32 and
+                                             batch_size * non_linear_layer.non_linear_kernel.shape[0]
+                                             < self._numba_threshold)
+
+        key = (batch_size, seq_len, torch.device(device), use_last_state)
+        if key != self._buffers_key:
+            # release the previous buffers, also bound by the layer functions, before allocating the new ones
+            self._memory_buffers, self._non_linear_buffers = None, None
+            self._memory_layer_fns, self._non_linear_layer_fns = None, None
+            # the last layer feeding the readout does not need a buffer if just the last state is used
+            memory_buffers = [
+                None if use_last_state and self._just_memory and idx == len(self.memory_layers) - 1
+                else torch.empty((seq_len, batch_size, layer.memory_kernel.shape[0]),
+                                 device=device, requires_grad=False, dtype=torch.float32)
+                for idx, layer in enumerate(self.memory_layers)
             ]
-        self._memory_states = [
-            torch.empty((batch_size, seq_len, layer.memory_kernel.shape[0]),
-                        device=device, requires_grad=False, dtype=torch.float32)
-            for layer in self.memory_layers
+            non_linear_buffers = [
+                None if use_last_state and idx == len(self.non_linear_layers) - 1
+                else torch.empty((seq_len, batch_size, layer.non_linear_kernel.shape[0]),
+                                 device=device, requires_grad=False, dtype=torch.float32)
+                for idx, layer in enumerate(self.non_linear_layers)
+            ] if not self._just_memory else None
+            self._memory_buffers, self._non_linear_buffers = memory_buffers, non_linear_buffers
+            self._buffers_key = key
+
+        # the states of the last memory layer are needed for all the time steps by the non-linear layers
+        self._memory_layer_fns = [
+            self._layer_function(layer, self._concatenate_memory_input[idx], False,
+                                 use_last_state and self._just_memory and idx == len(self.memory_layers) - 1,
+                                 self._memory_buffers[idx])
+            for idx, layer in enumerate(self.memory_layers)
         ]
+        # just the first non-linear layer receives the last memory state (default deep architecture)
+        self._non_linear_layer_fns = [
+            self._layer_function(layer, self._concatenate_non_linear_input[idx], idx == 0,
+                                 use_last_state and idx == len(self.non_linear_layers) - 1,
+                                 self._non_linear_buffers[idx])
+            for idx, layer in enumerate(self.non_linear_layers)
+        ] if not self._just_memory else None
+
+    @staticmethod
+    def _layer_function(layer: MemoryCell | NonLinearCell, concatenate_input: bool, memory_input: bool,
+                        last_state_only: bool, out: torch.Tensor | None) \
+            -> Callable[[torch.Tensor, torch.Tensor, torch.Tensor], torch.Tensor]:
+        """
+        Binds the forward pass of a layer over a whole sequence to its input, memory, and buffer choices, so that
+        they are taken once per call instead of at each batch.
+
+        :param layer: The memory or non-linear layer.
+        :param concatenate_input: Whether the input of the network is concatenated to the states of the previous
+        layer.
+        :param memory_input: Whether the layer receives the states of the last memory layer.
+        :param last_state_only: Whether the layer returns just its state at the last time step.
+        :param out: The buffer where the layer stores its states.
+
+        :return: A function of the states of the previous layer, the input of the network, and the states of the
+        last memory layer, returning the states of the layer.
+        """
+
+        if isinstance(layer, MemoryCell):
+            if concatenate_input:
+                return lambda h, x, m: layer.forward_sequence((h, x), last_state_only, out=out)
+            return lambda h, x, m: layer.forward_sequence(h, last_state_only, out=out)
+
+        if concatenate_input:
+            if memory_input:
+                return lambda h, x, m: layer.forward_sequence((h, x), m, last_state_only, out=out)
+            return lambda h, x, m: layer.forward_sequence((h, x), None, last_state_only, out=out)
+        if memory_input:
+            return lambda h, x, m: layer.forward_sequence(h, m, last_state_only, out=out)
+        return lambda h, x, m: layer.forward_sequence(h, None, last_state_only, out=out)
 
-    def _forward(self, x: torch.Tensor) \
-            -> tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+    def _forward(self, x: torch.Tensor, use_last_state: bool = False) -> torch.FloatTensor:
         """
         Forward method for the Deep Reservoir Memory Network.
 
         :param x: The input tensor.
+        :param use_last_state: Whether to return just the states at the last time step. In this case, the last layer
+        does not materialize its states for all the time steps. It must match the value given to _reset_state.
 
-        :return: The non-linear states, the non-linear state at the last time step,
-        the memory states, and the memory state at the last time step.
+        :return: The states fed to the readout, i.e., the non-linear states or, if just_memory is set, the memory
+        states. Either for all the time steps after the initial transients or just for the last time step.
         """
 
-        seq_len = x.shape[1]
+        # the recurrence works on time-major tensors, so that each time step is a contiguous (batch, units) slice
+        x = x.transpose(0, 1).contiguous()
 
         # iterate over the memory layers and compute the states
+        layers_memory_states = []
         last_memory_state = x
-        for idx, memory_layer in enumerate(self.memory_layers):
-            layer_states = self._memory_states[idx]
-            if self._concatenate_memory_input[idx]:
-                for t in range(seq_len):
-                    (layer_states[:, t, :].copy_
-                     (memory_layer(torch.cat([last_memory_state[:, t], x[:, t]], dim=-1))))
-            else:
-                for t in range(seq_len):
-                    layer_states[:, t, :].copy_(memory_layer(last_memory_state[:, t]))
-            last_memory_state = layer_states
+        for memory_layer_fn in self._memory_layer_fns:
+            last_memory_state = memory_layer_fn(last_memory_state, x, None)
+            layers_memory_states.append(last_memory_state)
 
         # iterate over the non-linear layers and compute the states
         if not self._just_memory:
+            layers_non_linear_states = []
             last_non_linear_state = x
-            for idx, non_linear_layer in enumerate(self.non_linear_layers):
-                layer_states = self._non_linear_states[idx]
-                # just the first non-linear layer receives the last memory state (default deep architecture)
-                if idx == 0:
-                    if self._concatenate_non_linear_input[idx]:
-                        for t in range(seq_len):
-                            layer_states[:, t, :].copy_(
-                                non_linear_layer(
-                                    torch.cat([last_non_linear_state[:, t], x[:, t]], dim=-1),
-                                    last_memory_state[:, t, :])
-                            )
-                    else:
-                        for t in range(seq_len):
-                            layer_states[:, t, :].copy_(
-                                non_linear_layer(last_non_linear_state[:, t], last_memory_state[:, t, :])
-                            )
-                else:
-                    if self._concatenate_non_linear_input[idx]:
-                        for t in range(seq_len):
-                            layer_states[:, t, :].copy_(
-                                non_linear_layer(
-                                    torch.cat([last_non_linear_state[:, t], x[:, t]], dim=-1))
-                            )
-                    else:
-                        for t in range(seq_len):
-                            layer_states[:, t, :].copy_(
-                                non_linear_layer(last_non_linear_state[:, t])
-                            )
-                last_non_linear_state = layer_states
-
-        if not self._just_memory:
-            if self._concatenate_non_linear:
-                non_linear_states = torch.cat(self._non_linear_states, dim=-1)
-            else:
-                non_linear_states = self._non_linear_states[-1]
+            for non_linear_layer_fn in self._non_linear_layer_fns:
+                last_non_linear_state = non_linear_layer_fn(last_non_linear_state, x, last_memory_state)
+                layers_non_linear_states.append(last_non_linear_state)
 
-        if self._concatenate_memory:
-            memory_states = torch.cat(self._memory_states, dim=-1)
+        if self._just_memory:
+            layers_states, concatenate = layers_memory_states, self._concatenate_memory
         else:
-            memory_states = self._memory_states[-1]
+            layers_states, concatenate = layers_non_linear_states, self._concatenate_non_linear
 
-        if not self._just_memory:
-            return (non_linear_states[:, self._initial_transients:, :], non_linear_states[:, -1, :],
-                    memory_states[:, self._initial_transients:, :], memory_states[:, -1, :])
+        if use_last_state:
+            # keep just the last time step of the layers that returned the states for all the time steps
+            layers_states = [states[-1] if states.dim() == 3 else states for states in layers_states]
         else:
-            return None, None, memory_states[:, self._initial_transients:, :], memory_states[:, -1, :]
+            # drop the initial transients and go back to batch-major tensors for the readout
+            layers_states = [states[self._initial_transients:].transpose(0, 1) for states in layers_states]
 
-    def _allocate(self, data: torch.utils.data.DataLoader, use_last_state: bool = True) \
-            -> tuple[np.ndarray, np.ndarray, int, int]:
-        batch_size = data.batch_size
-        num_batches = len(data)
-        state_size = self._total_non_linear_units if not self._just_memory else self._total_memory_units
+        if concatenate:
+            return torch.cat(layers_states, dim=-1)
+        return layers_states[-1].contiguous()
 
-        # pre-allocate memory for the states and the targets
+    def _capture_forward(self, x: torch.Tensor, use_last_state: bool) \
+            -> tuple[torch.cuda.CUDAGraph, torch.Tensor, torch.Tensor] | None:
+        """
+        Captures the forward pass in a CUDA graph. The capture does not run the forward pass, hence the graph must
+        be replayed to compute the states of the given batch. The states of the layers are updated in place by the
+        cells, so that each replay starts from the states left by the previous one.
+
+        :param x: The input batch on the device.
+        :param use_last_state: Whether to return just the states at the last time step.
+
+        :return: The graph, the static input to fill before each replay, and the static states written by each
+        replay, or None if the forward pass cannot be captured.
+        """
+
+        static_x = x.clone()
+        graph = torch.cuda.CUDAGraph()
+        try:
+            # thread local, so that the pin memory thread of the DataLoader can keep allocating pinned memory
+            with torch.cuda.graph(graph, capture_error_mode='thread_local'):
+                static_states = self._forward(static_x, use_last_state)
+        except RuntimeError:
+            # e.g., operations that synchronize with the host, the batches are then processed eagerly
+            return None
+
+        return graph, static_x, static_states
+
+    @staticmethod
+    def _to_device(x: torch.Tensor, device: torch.device, copy_stream: torch.cuda.Stream | None) -> torch.Tensor:
+        """
+        Moves the input batch to the device as a contiguous tensor, so that the copy is a single transfer and the
+        layers never receive strided inputs. On CUDA, the copy is issued asynchronously on the copy stream.
+
+        :param x: The input batch.
+        :param device: The device to move the batch to.
+        :param copy_stream: The CUDA stream for the host to device copies, or None to copy synchronously.
+
+        :return: The input batch on the device.
+        """
+
+        # a no-op for the batches collated by the DataLoader, which are already contiguous
+        x = (x.unsqueeze(-1) if x.dim() == 2 else x).contiguous()
+        if copy_stream is None:
+            return x.to(device)
+        with torch.cuda.stream(copy_stream):
+            return x.to(device, non_blocking=True)
+
+    def _iterate_states(self, data: torch.utils.data.DataLoader, device: torch.device, use_last_state: bool,
+                        desc: str, disable_progress_bar: bool, copy_stream: torch.cuda.Stream | None) \
+            -> Iterator[tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Computes the states fed to the readout batch by batch. On CUDA, the next batch is copied to the device on
+        the copy stream while the current one is processed. The states of a batch live in reused buffers, hence
+        they must be consumed before the next batch is requested.
+
+        :param data: The DataLoader for the input data.
+        :param device: The device to perform computations on.
+        :param use_last_state: Whether to use just the state at the last time step.
+        :param desc: The description of the progress bar.
+        :param disable_progress_bar: Whether to disable the progress bar.
+        :param copy_stream: The CUDA stream for the host to device copies, or None to copy synchronously.
+
+        :return: An iterator over the states on the device and the targets of each batch.
+        """
+
+        # the graph is captured after some eager batches, and replayed while the batches have the captured shape
+        use_graph = self._cuda_graph and torch.device(device).type == 'cuda'
+        graph = None
+
+        batches = iter(tqdm(data, desc=desc, disable=disable_progress_bar))
+        batch = next(batches, None)
+        next_x = self._to_device(batch[0], device, copy_stream) if batch is not None else None
+        batch_idx = 0
+        while batch is not None:
+            x, y = next_x, batch[1]
+            if copy_stream is not None:
+                torch.cuda.current_stream(device).wait_stream(copy_stream)
+                x.record_stream(torch.cuda.current_stream(device))
+            if use_graph and graph is None and batch_idx >= self.CUDA_GRAPH_WARMUP_BATCHES:
+                captured = self._capture_forward(x, use_last_state)
+                use_graph = captured is not None
+                if use_graph:
+                    graph, static_x, static_states = captured
+            if graph is not None and x.shape == static_x.shape:
+                static_x.copy_(x)
+                graph.replay()
+                batch_states = static_states
+            else:
+                batch_states = self._forward(x, use_last_state)
+            batch_idx += 1
+
+            # prefetch the next batch while the current one is being processed
+            batch = next(batches, None)
+            if batch is not None:
+                next_x = self._to_device(batch[0], device, copy_stream)
+
+            yield batch_states, y
+
+    def _compute_states(self, data: torch.utils.data.DataLoader, device: torch.device, use_last_state: bool,
+                        desc: str, disable_progress_bar: bool) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Computes the states fed to the readout for all the batches of the given data.
+        On CUDA, the next batch is copied to the device on a side stream while the current one is processed, and the
+        states are copied back asynchronously, straight into the pinned states array. The host to device copies
+        are asynchronous only if the DataLoader uses pin_memory=True.
+
+        :param data: The DataLoader for the input data.
+        :param device: The device to perform computations on.
+        :param use_last_state: Whether to use just the state at the last time step.
+        :param desc: The description of the progress bar.
+        :param disable_progress_bar: Whether to disable the progress bar.
+
+        :return: The states and the targets, flattened over the time steps if use_last_state is False.
+        """
+
+        copy_stream = torch.cuda.Stream(device) if torch.device(device).type == 'cuda' else None
+        states, ys, batch_size, seq_len = self._allocate(data, use_last_state, pin_memory=copy_stream is not None)
+        self._reset_state(batch_size, seq_len, device, use_last_state)
+        # tensor view of the pinned states array, used as destination of the device to host copies
+        host_states = torch.from_numpy(states) if copy_stream is not None else None
+
+        idx = 0
+        for batch_states, y in self._iterate_states(data, device, use_last_state, desc, disable_progress_bar,
+                                                    copy_stream):
+            if copy_stream is None:
+                states[idx:idx + batch_size] = batch_states.cpu().numpy()
+            else:
+                host_states[idx:idx + batch_size].copy_(batch_states, non_blocking=True)
+            ys[idx:idx + batch_size] = y.numpy()
+            idx += batch_size
+
+        if copy_stream is not None:
+            # wait for the pending device to host copies before using the states
+            torch.cuda.current_stream(device).synchronize()
+
+        if not use_last_state:
+            # flatten the time steps, the states are contiguous, hence this is a view
+            num_steps = states.shape[1]
+            states = states.reshape(-1, states.shape[-1])
+            if len(ys.shape) == 3:
+                ys = ys.reshape(-1, ys.shape[-1])
+            elif ys.shape[1] == 1:
+                # the same target for all the time steps of a sample, this materializes a copy
+                ys = np.repeat(ys, num_steps, axis=0)
+            else:
+                ys = ys.T
+
+        return states, ys
+
+    def _fit_readout_on_device(self, data: torch.utils.data.DataLoader, device: torch.device, use_last_state: bool,
+                               disable_progress_bar: bool) -> None:
+        """
+        Fits the ridge readout on the device without moving the states to the host. The statistics X^T X, X^T y,
+        y^T y, and the sums of X and y are accumulated batch by batch in float64. The intercept is not penalized, hence
+        the Gram matrix is centered, and its eigendecomposition gives the solutions for all the regularization
+        strengths. The strength is selected by generalized cross-validation, so that no batch is held out.
+
+        :param data: The DataLoader for the training data.
+        :param device: The device to perform computations on.
+        :param use_last_state: Whether to use just the state at the last time step.
+        :param disable_progress_bar: Whether to disable the progress bar.
+        """
+
+        copy_stream = torch.cuda.Stream(device) if torch.device(device).type == 'cuda' else None
+        batch_size, seq_len = data.batch_size, self._dataset_arrays(data)[0].shape[1]
+        self._reset_state(batch_size, seq_len, device, use_last_state)
+
+        # [X^T X, X^T y, sum of y^2, sum of X, sum of y, number of samples]
+        statistics = None
+        for batch_states, y in self._iterate_states(data, device, use_last_state, 'Fitting', disable_progress_bar,
+                                                    copy_stream):
+            # the targets are arranged as in _compute_states
+            y = y.to(device)
+            if not use_last_state:
+                if y.dim() == 3:
+                    y = y.reshape(-1, y.shape[-1])
+                elif y.shape[1] == 1:
+                    # the same target for all the time steps of a sample
+                    y = y.unsqueeze(1).expand(-1, batch_states.shape[1], -1).reshape(-1, 1)
+                else:
+                    # one target per time step of a single sequence
+                    y = y.T
+                batch_states = batch_states.reshape(-1, batch_states.shape[-1])
+            # the states are nearly rank-deficient, hence the products are computed in float64
+            x = batch_states.double()
+            y = y.double().reshape(x.shape[0], -1)
+            batch_statistics = [x.T @ x, x.T @ y, (y * y).sum(dim=0), x.sum(dim=0), y.sum(dim=0), x.shape[0]]
+            statistics = batch_statistics if statistics is None \
+                else [a + b for a, b in zip(statistics, batch_statistics)]
+
+        xtx, xty, y_squares, x_sum, y_sum, num_samples = statistics
+        x_mean, y_mean = x_sum / num_samples, y_sum / num_samples
+        # center the statistics, so that the intercept is not penalized
+        xtx = xtx - num_samples * torch.outer(x_mean, x_mean)
+        xty = xty - num_samples * torch.outer(x_mean, y_mean)
+        y_squares = y_squares - num_samples * y_mean ** 2
+
+        eigenvalues, eigenvectors = torch.linalg.eigh(xtx)
+        # tiny negative eigenvalues come from round-off
+        eigenvalues = eigenvalues.clamp(min=0)
+        projected_xty = eigenvectors.T @ xty
+
+        best_alpha, best_error = None, None
+        for alpha in self.readout.alphas:
+            # ||y - X w||^2 with w = Q (Λ + α I)^-1 Q^T X^T y, and the degrees of freedom of the fit with intercept
+            residuals = y_squares - (projected_xty ** 2 * ((eigenvalues + 2 * alpha) /
+                                                          (eigenvalues + alpha) ** 2)[:, None]).sum(dim=0)
+            dof = 1 + (eigenvalues / (eigenvalues + alpha)).sum()
+            error = residuals.clamp(min=0).mean() / (num_samples * (1 - dof / num_samples) ** 2)
+            if best_error is None or error < best_error:
+                best_alpha, best_error = alpha, error
+
+        w = eigenvectors @ (projected_xty / (eigenvalues + best_alpha)[:, None])
+        intercept = y_mean - x_mean @ w
+
+        self.readout.alpha_ = best_alpha
+        self.readout.coef_, self.readout.intercept_ = w.T.cpu().numpy(), intercept.cpu().numpy()
+        self.readout.n_features_in_ = w.shape[0]
+
+    @staticmethod
+    def _dataset_arrays(data: torch.utils.data.DataLoader) -> tuple[torch.Tensor, torch.Tensor]:
         dataset = data.dataset.dataset if isinstance(data.dataset, torch.utils.data.Subset) else data.dataset
         data_attr = getattr(dataset, 'data', None)
         target_attr = getattr(dataset, 'target', None)
         if data_attr is None or target_attr is None:
             raise AttributeError('Dataset does not have the required attributes `data` and `target`.')
+        return data_attr, target_attr
+
+    def _allocate(self, data: torch.utils.data.DataLoader, use_last_state: bool = True, pin_memory: bool = False) \
+            -> tuple[np.ndarray, np.ndarray, int, int]:
+        batch_size = data.batch_size
+        num_batches = len(data)
+        state_size = self._total_non_linear_units if not self._just_memory else self._total_memory_units
+
+        # pre-allocate memory for the states and the targets
+        data_attr, target_attr = self._dataset_arrays(data)
         seq_len = data_attr.shape[1]
-        states = np.empty((num_batches * batch_size, seq_len - self._initial_transients,
-                           state_size), dtype=np.float32) if not use_last_state \
-            else np.empty((num_batches * batch_size, state_size), dtype=np.float32)
+        states_shape = (num_batches * batch_size, seq_len - self._initial_transients, state_size) \
+            if not use_last_state else (num_batches * batch_size, state_size)
+        # pinned states can be the destination of asynchronous copies from the GPU
+        states = torch.empty(states_shape, dtype=torch.float32, pin_memory=True).numpy() if pin_memory \
+            else np.empty(states_shape, dtype=np.float32)
         if len(target_attr.shape) == 2:
-            ys = np.empty((num_batches * batch_size, target_attr.shape[1]), dtype=np.float32, order='F')
+            ys = np.empty((num_batches * batch_size, target_attr.shape[1]), dtype=np.float32)
         else:
-            ys = np.empty((num_batches * batch_size, target_attr.shape[1], target_attr.shape[2]),
-                          dtype=np.float32, order='F')
+            ys = np.empty((num_batches * batch_size, target_attr.shape[1], target_attr.shape[2]), dtype=np.float32)
 
         return states, ys, batch_size, seq_len
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def fit(self, data: torch.utils.data.DataLoader, device: torch.device, standardize: bool = False,
             use_last_state: bool = True, disable_progress_bar: bool = False) -> None:
         """
         Fits the deep reservoir memory network on the given data.
 
-        :param data: The DataLoader for the training data.
+        :param data: The DataLoader for the training data. On CUDA, use pin_memory=True to overlap the copies
+        of the batches with the computation.
         :param device: The device to perform computations on.
         :param standardize: Whether to standardize the states before fitting the readout layer.
         :param use_last_state: Whether to use the state at the last time step for fitting the readout layer.
         :param disable_progress_bar: Whether to disable the progress bar.
         """
 
-        states, ys, batch_size, seq_len = self._allocate(data, use_last_state)
-        self._reset_state(batch_size, seq_len, device)
-
-        if device == torch.device('cuda'):
-            torch.cuda.empty_cache()
+        if standardize and self._gpu_ridge:
+            raise ValueError('Standardization is not supported when the readout is fitted on the device.')
 
         self._trained = True
-        idx = 0
         try:
-            for x, y in tqdm(data, desc='Fitting', disable=disable_progress_bar):
-                x = x.to(device)
-                states[idx:idx + batch_size] = self._forward(x.unsqueeze(-1) if x.dim() == 2 else x)[3 if self._just_memory else 1].cpu().numpy() \
-                    if use_last_state else self._forward(x.unsqueeze(-1) if x.dim() == 2 else x)[2 if self._just_memory else 0].cpu().numpy()
-                ys[idx:idx + batch_size] = y.numpy()
-                idx += batch_size
+            if self._gpu_ridge:
+                self._fit_readout_on_device(data, device, use_last_state, disable_progress_bar)
+                return
 
-            if not use_last_state:
-                states = np.concatenate(states, axis=0)
-                if len(ys.shape) == 3:
-                    ys = np.concatenate(ys, axis=0)
-                else:
-                    ys = np.repeat(ys, states.shape[0] // ys.shape[0], axis=0) if ys.shape[1] == 1 else ys.T
+            states, ys = self._compute_states(data, device, use_last_state, 'Fitting', disable_progress_bar)
 
             if standardize:
                 self._scaler = StandardScaler().fit(states)
@@ -416,14 +703,15 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
             self._trained = False
             raise e
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def score(self, data: torch.utils.data.DataLoader, score_function: Callable[[np.ndarray, np.ndarray], float],
               device: torch.device, standardize: bool = False,
               use_last_state: bool = True, disable_progress_bar: bool = False) -> float:
         """
         Scores the deep reservoir memory network on the given data.
 
-        :param data: The DataLoader for the input data.
+        :param data: The DataLoader for the input data. On CUDA, use pin_memory=True to overlap the copies
+        of the batches with the computation.
         :param score_function: The scoring function.
         :param device: The device to perform computations on.
         :param standardize: Whether to standardize the states before scoring.
@@ -438,39 +726,21 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
             if self._scaler is None:
                 raise ValueError('Standardization is enabled but the model has not been fitted yet.')
 
-        states, ys, batch_size, seq_len = self._allocate(data, use_last_state)
-        self._reset_state(batch_size, seq_len, device)
-
-        if device == torch.device('cuda'):
-            torch.cuda.empty_cache()
-
-        idx = 0
-        for x, y in tqdm(data, desc='Scoring', disable=disable_progress_bar):
-            x = x.to(device)
-            states[idx:idx + batch_size] = self._forward(x.unsqueeze(-1) if x.dim() == 2 else x)[3 if self._just_memory else 1].cpu().numpy() \
-                if use_last_state else self._forward(x.unsqueeze(-1) if x.dim() == 2 else x)[2 if self._just_memory else 0].cpu().numpy()
-            ys[idx:idx + batch_size] = y.numpy()
-            idx += batch_size
-
-        if not use_last_state:
-            states = np.concatenate(states, axis=0)
-            if len(ys.shape) == 3:
-                ys = np.concatenate(ys, axis=0)
-            else:
-                ys = np.repeat(ys, states.shape[0] // ys.shape[0], axis=0) if ys.shape[1] == 1 else ys.T
+        states, ys = self._compute_states(data, device, use_last_state, 'Scoring', disable_progress_bar)
 
         if standardize:
             states = self._scaler.transform(states)
 
         return score_function(self.readout.predict(states), ys)
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def predict(self, data: torch.utils.data.DataLoader, device: torch.device, standardize: bool = False,
                 use_last_state: bool = True, disable_progress_bar: bool = False) -> np.ndarray:
         """
         Predicts the target values of the deep reservoir memory network on the given data.
 
-        :param data: The DataLoader for the input data.
+        :param data: The DataLoader for the input data. On CUDA, use pin_memory=True to overlap the copies
+        of the batches with the computation.
         :param device: The device to perform computations on.
         :param standardize: Whether to standardize the states before predicting.
         :param use_last_state: Whether to use the state at the last time step for predicting.
@@ -485,21 +755,7 @@ class DeepReservoirMemoryNetwork(torch.nn.Module):
             if self._scaler is None:
                 raise ValueError('Standardization is enabled but the model has not been fitted yet.')
 
-        states, _, batch_size, seq_len = self._allocate(data, use_last_state)
-        self._reset_state(batch_size, seq_len, device)
-
-        if device == torch.device('cuda'):
-            torch.cuda.empty_cache()
-
-        idx = 0
-        for x, _ in tqdm(data, desc='Predicting', disable=disable_progress_bar):
-            x = x.to(device)
-            states[idx:idx + batch_size] = self._forward(x.unsqueeze(-1) if x.dim() == 2 else x)[3 if self._just_memory else 1].cpu().numpy() \
-                if use_last_state else self._forward(x.unsqueeze(-1) if x.dim() == 2 else x)[2 if self._just_memory else 0].cpu().numpy()
-            idx += batch_size
-
-        if not use_last_state:
-            states = np.concatenate(states, axis=0)
+        states, _ = self._compute_states(data, device, use_last_state, 'Predicting', disable_progress_bar)
 
         if standardize:
             states = self._scaler.transform(states)
@@ -0,0 +1,97 @@
+import importlib.util
+
+import numpy as np
+
+# numba is imported, and the kernel compiled, just the first time the recurrence runs
+NUMBA_AVAILABLE = importlib.util.find_spec('numba') is not None
+numba = None
+_compiled_recurrence = None
+
+
+def _recurrence(projected_input: np.ndarray, kernel: np.ndarray, indptr: np.ndarray, indices: np.ndarray,
+                data: np.ndarray, sparse: bool, state: np.ndarray, step_rate: float, euler: bool, tanh: bool,
+                store_states: bool, out: np.ndarray) -> None:
+    """
+    Run the recurrence h(t) = (1 - a) * h(t-1) + a * f(h(t-1) * W + p(t)), or h(t) = h(t-1) + ε * f(h(t-1) * W + p(t))
+    if euler is set, over a whole sequence of projected inputs. The matrix-vector product, the non-linearity, and the
+    state update are fused in a single pass over the state, and the batch is processed in parallel.
+    The memory recurrence m(t) = m(t-1) * M + p(t) is obtained with a = 1 and no non-linearity.
+    A sparse kernel is given in CSR format, so that the matrix-vector product visits just the non-zero weights.
+
+    :param projected_input: Projected inputs of shape (seq_len, batch_size, units).
+    :param kernel: Dense recurrent kernel of shape (units, units), unused if sparse is set.
+    :param indptr: Row pointers of the CSR recurrent kernel, unused if sparse is not set.
+    :param indices: Column indices of the CSR recurrent kernel, unused if sparse is not set.
+    :param data: Non-zero weights of the CSR recurrent kernel, unused if sparse is not set.
+    :param sparse: Whether to use the CSR recurrent kernel instead of the dense one.
+    :param state: State at time t-1 of shape (batch_size, units), updated in place with the last state.
+    :param step_rate: Leaky rate, or Euler integration step size if euler is set.
+    :param euler: Whether to use Euler integration.
+    :param tanh: Whether to apply the tanh non-linearity.
+    :param store_states: Whether to store the states for all the time steps in out.
+    :param out: Array of shape (seq_len, batch_size, units) where to store the states.
+    """
+
+    seq_len, batch_size, units = projected_input.shape
+    for b in numba.prange(batch_size):
+        h = state[b].copy()
+        activation = np.empty(units, dtype=np.float32)
+        for t in range(seq_len):
+            activation[:] = projected_input[t, b]
+            if sparse:
+                for i in range(units):
+                    h_i = h[i]
+                    for k in range(indptr[i], indptr[i + 1]):
+                        activation[indices[k]] += h_i * data[k]
+            else:
+                for i in range(units):
+                    h_i = h[i]
+                    for j in range(units):
+                        activation[j] += h_i * kernel[i, j]
+            for j in range(units):
+                a = np.tanh(activation[j]) if tanh else activation[j]
+                h[j] = h[j] + step_rate * a if euler else (1 - step_rate) * h[j] + step_rate * a
+            if store_states:
+                out[t, b] = h
+        state[b] = h
+
+
+def numpy_kernels(kernel: np.ndarray, max_density: float = 0.1) \
+        -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, bool]:
+    """
+    Prepare a recurrent kernel for the compiled recurrence. A kernel with less than max_density non-zero weights is
+    converted to CSR format, otherwise it is kept dense. Unlike the PyTorch sparse products, the sparse loop has no
+    dispatch overhead, hence there is no minimum size.
+
+    :param kernel: Recurrent kernel of shape (units, units).
+    :param max_density: Maximum fraction of non-zero weights for the kernel to be considered sparse.
+
+    :return: The dense kernel, the CSR row pointers, column indices, and weights, and whether the kernel is sparse.
+    The arrays of the unused format are empty.
+    """
+
+    kernel = np.ascontiguousarray(kernel, dtype=np.float32)
+    rows, columns = np.nonzero(kernel)
+    if len(rows) >= max_density * kernel.size:
+        empty_index = np.empty(0, dtype=np.int64)
+        return kernel, empty_index, empty_index, np.empty(0, dtype=np.float32), False
+
+    # np.nonzero returns the indices in row-major order, as required by CSR
+    indptr = np.zeros(kernel.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=kernel.shape[0]), out=indptr[1:])
+    return np.empty((0, 0), dtype=np.float32), indptr, columns.astype(np.int64), kernel[rows, columns], True
+
+
+def recurrence(projected_input: np.ndarray, kernels: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, bool],
+               state: np.ndarray, step_rate: float, euler: bool, tanh: bool, store_states: bool,
+               out: np.ndarray) -> None:
+    """
+    Run the compiled recurrence, compiling it on the first call. See `_recurrence` for the parameters, the kernels
+    are the ones returned by `numpy_kernels`.
+    """
+
+    global numba, _compiled_recurrence
+    if _compiled_recurrence is None:
+        import numba
+        _compiled_recurrence = numba.njit(parallel=True, fastmath=True, cache=True)(_recurrence)
+    _compiled_recurrence(projected_input, *kernels, state, step_rate, euler, tanh, store_states, out)
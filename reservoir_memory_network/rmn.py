@@ -1,10 +1,13 @@
 import torch
+import numpy as np
 import time
 
 from typing import Callable
 
 from utils.initialization import init_memory_kernel, init_input_kernel, init_non_linear_kernel, init_bias
 
+from .numba_kernels import numpy_kernels, recurrence
+
 
 def validate_params_memory(input_units: int, memory_units: int, input_memory_connectivity: int, distribution: str,
                            signs_from: str, theta: float) -> None:
@@ -36,7 +39,7 @@ def validate_params_memory(input_units: int, memory_units: int, input_memory_con
 def validate_params_non_linear(input_units: int, non_linear_units: int, memory_units: int, leaky_rate: float,
                                memory_non_linear_connectivity: int, input_non_linear_connectivity: int,
                                non_linear_connectivity: int, distribution: str, non_linearity: str,
-                               signs_from: str) -> None:
+                               signs_from: str, compute_dtype: torch.dtype = torch.float32) -> None:
     """
     Validate the parameters for the non-linear cell.
 
@@ -50,6 +53,7 @@ def validate_params_non_linear(input_units: int, non_linear_units: int, memory_u
     :param distribution: Distribution of the weights.
     :param non_linearity: Non-linearity function.
     :param signs_from: Source of weight signs.
+    :param compute_dtype: Data type of the matrix products.
     """
 
     if input_units < 1:
@@ -72,6 +76,224 @@ def validate_params_non_linear(input_units: int, non_linear_units: int, memory_u
         raise ValueError("Non-linearity must be 'tanh' or 'identity'.")
     if signs_from not in [None, 'random', 'pi', 'e', 'logistic']:
         raise ValueError("Signs from must be None, 'random', 'pi', 'e', or 'logistic'.")
+    if not compute_dtype.is_floating_point:
+        raise ValueError("Compute dtype must be a floating point data type.")
+
+
+def project_inputs(inputs: torch.Tensor | tuple[torch.Tensor, ...], kernel: torch.Tensor,
+                   bias: torch.Tensor | None = None, out: torch.Tensor | None = None) -> torch.Tensor:
+    """
+    Project the inputs with the given kernel using a single matrix product over all the leading dimensions.
+    A tuple of inputs is treated as their concatenation along the last dimension, but each input is multiplied
+    by the corresponding block of rows of the kernel, so that the concatenation is never materialized.
+
+    If the kernel has a lower precision than the inputs, the products are computed in the precision of the kernel
+    and the result is cast back to the precision of the inputs before adding the bias.
+
+    :param inputs: Input tensor, or tuple of input tensors, of shape (..., input_units).
+    :param kernel: Kernel of shape (input_units, units).
+    :param bias: Optional bias of shape (units,).
+    :param out: Optional contiguous tensor of shape (..., units) where to store the projection.
+
+    :return: The projected inputs of shape (..., units).
+    """
+
+    if isinstance(inputs, torch.Tensor):
+        inputs = (inputs,)
+
+    low_precision = kernel.dtype != inputs[0].dtype
+    projected = None if out is None or low_precision else out.view(-1, out.shape[-1])
+    offset = 0
+    for idx, x in enumerate(inputs):
+        x_kernel = kernel[offset:offset + x.shape[-1]]
+        offset += x.shape[-1]
+        x = x.reshape(-1, x.shape[-1]).to(kernel.dtype)
+        if idx > 0:
+            projected.addmm_(x, x_kernel)
+        elif bias is not None and not low_precision:
+            projected = torch.addmm(bias, x, x_kernel, out=projected)
+        else:
+            projected = torch.mm(x, x_kernel, out=projected)
+
+    if low_precision:
+        projected = projected.to(inputs[0].dtype) if out is None else out.view(-1, out.shape[-1]).copy_(projected)
+        if bias is not None:
+            projected.add_(bias)
+
+    return projected.view(*inputs[0].shape[:-1], -1)
+
+
+def sparsify_kernel(kernel: torch.Tensor, max_density: float = 0.1, min_units: int = 256) -> torch.Tensor | None:
+    """
+    Convert a recurrent kernel to a sparse CSR tensor if its density is below the given threshold and it has at
+    least min_units units (256 by default). Below that size, the dispatch of the sparse product and of the separate
+    addition costs more than the fused dense product it replaces, hence small kernels stay dense.
+    The kernel is transposed, so that the recurrent input is computed as a sparse matrix times a dense matrix.
+
+    :param kernel: Recurrent kernel of shape (units, units).
+    :param max_density: Maximum fraction of non-zero weights for the kernel to be considered sparse.
+    :param min_units: Minimum number of units for the kernel to be converted.
+
+    :return: The transposed kernel as a sparse CSR tensor, or None if the kernel is kept dense.
+    """
+
+    if kernel.shape[0] < min_units or torch.count_nonzero(kernel).item() >= max_density * kernel.numel():
+        return None
+    return kernel.t().to_sparse_csr()
+
+
+def sparse_recurrent_input(projected_input: torch.Tensor, state: torch.Tensor,
+                           sparse_kernel_t: torch.Tensor) -> torch.Tensor:
+    """
+    Add the recurrent input to the projected input using a sparse recurrent kernel.
+
+    :param projected_input: Projected input at time t.
+    :param state: State at time t-1.
+    :param sparse_kernel_t: Transposed recurrent kernel as returned by `sparsify_kernel`.
+
+    :return: The sum of the projected input and the recurrent input.
+    """
+
+    # (W^T * h^T)^T = h * W
+    return projected_input + torch.mm(sparse_kernel_t, state.t()).t()
+
+
+def numba_recurrence(projected_input: torch.Tensor, kernels: tuple, state: torch.Tensor, step_rate: float,
+                     euler: bool, tanh: bool, last_state_only: bool,
+                     out: torch.Tensor | None = None) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Run the recurrence over a whole sequence of projected inputs on CPU with the compiled Numba kernel.
+
+    :param projected_input: Contiguous projected inputs of shape (seq_len, batch_size, units).
+    :param kernels: Recurrent kernel as returned by `numpy_kernels`.
+    :param state: State at time t-1 of shape (batch_size, units).
+    :param step_rate: Leaky rate, or Euler integration step size if euler is set.
+    :param euler: Whether to use Euler integration.
+    :param tanh: Whether to apply the tanh non-linearity.
+    :param last_state_only: Whether to compute just the state at the last time step.
+    :param out: Optional tensor of shape (seq_len, batch_size, units) where to store the states. It may be the
+    projected inputs themselves, since each projected input is read before the corresponding state is written.
+
+    :return: The states for all the time steps, or just the last one, and the state at the last time step.
+    """
+
+    last_state = state.numpy().copy()
+    if last_state_only:
+        states = np.empty((0, 0, 0), dtype=np.float32)
+    else:
+        out = torch.empty_like(projected_input) if out is None else out
+        states = out.numpy()
+    recurrence(projected_input.numpy(), kernels, last_state, step_rate, euler, tanh, not last_state_only, states)
+    last_state = torch.from_numpy(last_state)
+
+    return last_state if last_state_only else out, last_state
+
+
+def _add_recurrent_input(projected_input: torch.Tensor, state: torch.Tensor, kernel: torch.Tensor) -> torch.Tensor:
+    """
+    Add the recurrent input to the projected input. If the kernel has a lower precision than the state, the matrix
+    product is computed in the precision of the kernel and the result is cast back to the precision of the state.
+
+    :param projected_input: Projected input at time t.
+    :param state: State at time t-1.
+    :param kernel: Recurrent kernel.
+
+    :return: The sum of the projected input and the recurrent input.
+    """
+
+    if kernel.dtype == state.dtype:
+        return torch.addmm(projected_input, state, kernel)
+    return projected_input + torch.mm(state.to(kernel.dtype), kernel).to(state.dtype)
+
+
+def _memory_step(memory_state: torch.Tensor, projected_input: torch.Tensor,
+                 memory_kernel: torch.Tensor) -> torch.Tensor:
+    """
+    Single step of the memory recurrence.
+
+    :param memory_state: Memory state at time t-1.
+    :param projected_input: Projection of the input at time t.
+    :param memory_kernel: Memory kernel.
+
+    :return: The memory state at time t.
+    """
+
+    # m(t) = Vm * m(t-1) + Vx * x(t)
+    return torch.addmm(projected_input, memory_state, memory_kernel)
+
+
+def _non_linear_update(non_linear_state: torch.Tensor, activation: torch.Tensor, leaky_rate: float,
+                       tanh: bool) -> torch.Tensor:
+    """
+    Leaky integration of the non-linear state given the pre-activation.
+
+    :param non_linear_state: Non-linear state at time t-1.
+    :param activation: Pre-activation at time t.
+    :param leaky_rate: Leaky rate.
+    :param tanh: Whether to apply the tanh non-linearity.
+
+    :return: The non-linear state at time t.
+    """
+
+    if tanh:
+        activation = torch.tanh(activation)
+    return non_linear_state * (1 - leaky_rate) + activation * leaky_rate
+
+
+def _euler_update(non_linear_state: torch.Tensor, activation: torch.Tensor, epsilon: float,
+                  tanh: bool) -> torch.Tensor:
+    """
+    Euler integration of the non-linear state given the pre-activation.
+
+    :param non_linear_state: Non-linear state at time t-1.
+    :param activation: Pre-activation at time t.
+    :param epsilon: Euler integration step size.
+    :param tanh: Whether to apply the tanh non-linearity.
+
+    :return: The non-linear state at time t.
+    """
+
+    if tanh:
+        activation = torch.tanh(activation)
+    return non_linear_state + activation * epsilon
+
+
+def _non_linear_step(non_linear_state: torch.Tensor, projected_input: torch.Tensor, non_linear_kernel: torch.Tensor,
+                     leaky_rate: float, tanh: bool) -> torch.Tensor:
+    """
+    Single step of the non-linear recurrence using the leaky integrator.
+
+    :param non_linear_state: Non-linear state at time t-1.
+    :param projected_input: Projection of the input (and of the memory state) at time t, bias included.
+    :param non_linear_kernel: Non-linear kernel.
+    :param leaky_rate: Leaky integrator rate.
+    :param tanh: Whether to apply the tanh non-linearity.
+
+    :return: The non-linear state at time t.
+    """
+
+    # h(t) = (1 - a) * h(t-1) + a * f(W * h(t-1) + Wm * m(t) + Wx * x(t) + b)
+    activation = _add_recurrent_input(projected_input, non_linear_state, non_linear_kernel)
+    return _non_linear_update(non_linear_state, activation, leaky_rate, tanh)
+
+
+def _euler_step(non_linear_state: torch.Tensor, projected_input: torch.Tensor, non_linear_kernel: torch.Tensor,
+                epsilon: float, tanh: bool) -> torch.Tensor:
+    """
+    Single step of the non-linear recurrence using Euler integration.
+
+    :param non_linear_state: Non-linear state at time t-1.
+    :param projected_input: Projection of the input (and of the memory state) at time t, bias included.
+    :param non_linear_kernel: Non-linear kernel.
+    :param epsilon: Euler integration step size.
+    :param tanh: Whether to apply the tanh non-linearity.
+
+    :return: The non-linear state at time t.
+    """
+
+    # h(t) = h(t-1) + ε * f(Wx * x(t) + Wm * m(t) + (W - γ * I) * h(t-1) + b)
+    activation = _add_recurrent_input(projected_input, non_linear_state, non_linear_kernel)
+    return _euler_update(non_linear_state, activation, epsilon, tanh)
 
 
 class MemoryCell(torch.nn.Module):
@@ -91,7 +313,8 @@ class MemoryCell(torch.nn.Module):
                  legendre_input: bool = False,
                  distribution: str = 'uniform',
                  signs_from: str | None = None,
-                 fixed_input_kernel: bool = False, ) \
+                 fixed_input_kernel: bool = False,
+                 parallel_scan: bool = False) \
             -> None:
         """
         Initialize the memory cell.
@@ -106,6 +329,7 @@ class MemoryCell(torch.nn.Module):
         :param distribution: Distribution of the weights.
         :param signs_from: Source of weight signs.
         :param fixed_input_kernel: Whether to use fixed input kernel.
+        :param parallel_scan: Whether to compute the memory states with a parallel prefix scan over time.
         """
 
         super().__init__()
@@ -119,9 +343,69 @@ class MemoryCell(torch.nn.Module):
         )
 
         self.memory_kernel = init_memory_kernel(memory_units, theta, legendre, memory_scaling)
+        self._parallel_scan = parallel_scan
         self._memory_state = None
+        # transposed memory kernel as a sparse CSR tensor if it is sparse enough, set by reset_state
+        self._sparse_memory_kernel = None
+        # memory kernel arrays for the Numba recurrence, set by reset_state if the recurrence runs with Numba
+        self._numpy_kernels = None
+
+    def project(self, x: torch.Tensor | tuple[torch.Tensor, ...],
+                out: torch.FloatTensor | None = None) -> torch.FloatTensor:
+        """
+        Project the input onto the memory units with a single matrix product over all the leading dimensions.
+
+        :param x: Input tensor, or tuple of tensors to be concatenated, of shape (..., input_units).
+        :param out: Optional contiguous tensor of shape (..., memory_units) where to store the projection.
+
+        :return: The projected input of shape (..., memory_units).
+        """
+
+        # Vx * x
+        return project_inputs(x, self.input_memory_kernel, out=out)
+
+    def recurrence_only(self, memory_state: torch.FloatTensor, projected_input: torch.FloatTensor) \
+            -> torch.FloatTensor:
+        """
+        Recurrence of the memory cell on an input already projected by `project`.
+
+        :param memory_state: Memory state at time t-1.
+        :param projected_input: Projected input at time t.
+
+        :return: The memory state at time t.
+        """
+
+        if self._sparse_memory_kernel is not None:
+            return sparse_recurrent_input(projected_input, memory_state, self._sparse_memory_kernel)
+        return _memory_step(memory_state, projected_input, self.memory_kernel)
+
+    def _scan(self, projected_input: torch.FloatTensor) -> torch.FloatTensor:
+        """
+        Compute the memory states for all the time steps with a parallel (Hillis-Steele) prefix scan.
+        Since the memory recurrence is linear, m(t) = sum_k Vm^k * Vx * x(t-k), and the partial sums are built
+        in ceil(log2(seq_len)) batched matrix products instead of seq_len sequential ones.
+        This trades O(seq_len) for O(seq_len * log(seq_len)) work, hence it pays off on GPUs and long sequences.
+
+        :param projected_input: Projected input of shape (seq_len, batch_size, memory_units).
+
+        :return: The memory states for all the time steps.
+        """
 
-    @torch.no_grad()
+        states = projected_input
+        # the previous memory state enters the first time step
+        states[0].addmm_(self._memory_state, self.memory_kernel)
+        kernel_power = self.memory_kernel
+        offset = 1
+        while offset < states.shape[0]:
+            # s(t) = s(t) + Vm^offset * s(t - offset)
+            states[offset:].add_(torch.matmul(states[:-offset], kernel_power))
+            kernel_power = torch.mm(kernel_power, kernel_power)
+            offset *= 2
+        self._memory_state.copy_(states[-1])
+
+        return states
+
+    @torch.inference_mode()
     def forward(self, xt: torch.Tensor) -> torch.FloatTensor:
         """
         Forward pass for the memory cell.
@@ -131,21 +415,79 @@ class MemoryCell(torch.nn.Module):
         :return: The memory state at time t.
         """
 
-        # m(t) = Vm * m(t-1) + Vx * x(t)
-        self._memory_state = torch.addmm(torch.mm(self._memory_state, self.memory_kernel), xt, self.input_memory_kernel)
+        self._memory_state = self.recurrence_only(self._memory_state, self.project(xt))
 
         return self._memory_state
 
-    def reset_state(self, batch_size: int, device: torch.device) -> None:
+    @torch.inference_mode()
+    def forward_sequence(self, x_seq: torch.Tensor | tuple[torch.Tensor, ...], last_state_only: bool = False,
+                         out: torch.FloatTensor | None = None) -> torch.FloatTensor:
+        """
+        Forward pass for the memory cell over a whole sequence.
+        The input projection is computed for all the time steps at once, so that just the recurrence is left
+        inside the time loop.
+
+        :param x_seq: Input tensor, or tuple of tensors to be concatenated, of shape
+        (seq_len, batch_size, input_units).
+        :param last_state_only: Whether to return just the memory state at the last time step.
+        :param out: Optional tensor of shape (seq_len, batch_size, memory_units) where to store the states.
+
+        :return: The memory states for all the time steps, or just the last one.
+        """
+
+        # the memory state is updated in place, so that it lives at a fixed address across the calls, as required
+        # by the CUDA graphs replaying this method
+        if self._numpy_kernels is not None:
+            # the recurrence overwrites the projected inputs with the states
+            states, memory_state = numba_recurrence(
+                self.project(x_seq, out=None if last_state_only else out), self._numpy_kernels, self._memory_state,
+                1.0, False, False, last_state_only, out)
+            self._memory_state.copy_(memory_state)
+            return states
+
+        if self._parallel_scan:
+            states = self._scan(self.project(x_seq, out=None if last_state_only else out))
+            return states[-1] if last_state_only else states
+
+        projected_input = self.project(x_seq)
+
+        memory_state = self._memory_state
+        if last_state_only:
+            for t in range(projected_input.shape[0]):
+                memory_state = self.recurrence_only(memory_state, projected_input[t])
+            self._memory_state.copy_(memory_state)
+            return memory_state
+
+        states = [None] * projected_input.shape[0]
+        for t in range(projected_input.shape[0]):
+            memory_state = self.recurrence_only(memory_state, projected_input[t])
+            states[t] = memory_state
+        self._memory_state.copy_(memory_state)
+
+        return torch.stack(states, dim=0, out=out)
+
+    def numpy_kernels(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, bool]:
+        """
+        Memory kernel as float32 NumPy arrays for the Numba recurrence, in CSR format if it is sparse.
+
+        :return: The memory kernel as returned by `numpy_kernels`.
+        """
+
+        return numpy_kernels(self.memory_kernel.detach().cpu().numpy())
+
+    def reset_state(self, batch_size: int, device: torch.device, numba: bool = False) -> None:
         """
         Reset the memory state.
 
         :param batch_size: The batch size.
         :param device: The device to use.
+        :param numba: Whether to run the recurrence with the compiled Numba kernel. Requires a CPU device.
         """
 
         self._memory_state = torch.zeros((batch_size, self.memory_kernel.shape[0]), dtype=torch.float32,
                                          device=device, requires_grad=False)
+        self._sparse_memory_kernel = sparsify_kernel(self.memory_kernel)
+        self._numpy_kernels = self.numpy_kernels() if numba else None
 
 
 class NonLinearCell(torch.nn.Module):
@@ -176,7 +518,8 @@ class NonLinearCell(torch.nn.Module):
                  circular_non_linear_kernel: bool = False,
                  euler: bool = False,
                  epsilon: float = 1e-3,
-                 gamma: float = 1e-3) -> None:
+                 gamma: float = 1e-3,
+                 compute_dtype: torch.dtype = torch.float32) -> None:
         """
         Initialize the non-linear cell.
 
@@ -202,16 +545,17 @@ class NonLinearCell(torch.nn.Module):
         :param euler: Where to use Euler integration.
         :param epsilon: Euler integration step size.
         :param gamma: Diffusion coefficient for the Euler recurrent kernel.
+        :param compute_dtype: Data type of the matrix products, e.g., torch.bfloat16 to use the tensor cores of recent
+        GPUs. The states and the non-linearity are always computed in float32.
         """
 
         super().__init__()
 
         validate_params_non_linear(input_units, non_linear_units, memory_units, leaky_rate,
                                    memory_non_linear_connectivity, input_non_linear_connectivity,
-                                   non_linear_connectivity, distribution, non_linearity, signs_from)
+                                   non_linear_connectivity, distribution, non_linearity, signs_from, compute_dtype)
 
-        self._leaky_rate = torch.tensor(leaky_rate, dtype=torch.float32, requires_grad=False)
-        self._one_minus_leaky_rate = torch.tensor(1 - leaky_rate, dtype=torch.float32, requires_grad=False)
+        self._tanh = non_linearity == 'tanh'
 
         self.input_non_linear_kernel = init_input_kernel(
             input_units, non_linear_units, input_non_linear_connectivity,
@@ -223,110 +567,143 @@ class NonLinearCell(torch.nn.Module):
                                                         spectral_radius, leaky_rate, effective_rescaling,
                                                         circular_non_linear_kernel, euler, gamma,
                                                         non_linear_scaling)
-        self._epsilon = torch.tensor(epsilon, dtype=torch.float32, requires_grad=False)
         self.memory_non_linear_kernel = init_input_kernel(memory_units, non_linear_units,
                                                           memory_non_linear_connectivity, memory_non_linear_scaling,
                                                           distribution)
         self.bias = init_bias(bias, non_linear_units, input_non_linear_scaling, bias_scaling)
 
-        self._non_linear_function: \
-            Callable[[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor | None], torch.FloatTensor] = \
-            lambda x, out=None: torch.tanh(x, out=out) if non_linearity == 'tanh' else torch.add(x, 0, out=out)
-        self._out = None
-
         self._non_linear_state = None
-        self._forward_function: Callable[[torch.Tensor, torch.FloatTensor], torch.FloatTensor] = (
-            self._forward_euler) if euler else self._forward_leaky_integrator
+        self._step_function: Callable[[torch.Tensor, torch.Tensor, torch.Tensor, float, bool], torch.Tensor] = (
+            _euler_step if euler else _non_linear_step)
+        self._update_function: Callable[[torch.Tensor, torch.Tensor, float, bool], torch.Tensor] = (
+            _euler_update if euler else _non_linear_update)
+        self._step_rate = epsilon if euler else leaky_rate
+        self._compute_dtype = compute_dtype
+        # kernels cast to the compute data type, set by reset_state
+        self._projection_kernel = None
+        self._recurrent_kernel = None
+        # transposed recurrent kernel as a sparse CSR tensor if it is sparse enough, set by reset_state
+        self._sparse_recurrent_kernel = None
+        self._euler = euler
+        # recurrent kernel arrays for the Numba recurrence, set by reset_state if the recurrence runs with Numba
+        self._numpy_kernels = None
+
+    def project(self, x: torch.Tensor | tuple[torch.Tensor, ...],
+                memory_state: torch.FloatTensor | None = None) -> torch.FloatTensor:
+        """
+        Project the input and, if given, the memory state onto the non-linear units, bias included.
+        Each projection is a single matrix product over all the leading dimensions.
 
-    @torch.no_grad()
-    def _forward_leaky_integrator(self, xt: torch.Tensor,
-                                  memory_state: torch.FloatTensor | None = None) -> torch.FloatTensor:
+        :param x: Input tensor, or tuple of tensors to be concatenated, of shape (..., input_units).
+        :param memory_state: Memory state tensor of shape (..., memory_units).
+        :return: The projected input of shape (..., non_linear_units).
         """
-        Forward pass for the non-linear cell using the leaky integrator.
 
-        :param xt: Input tensor at time t.
-        :param memory_state: Memory state at time t.
-        :return: The non-linear state at time t.
+        # Wx * x + Wm * m + b, the memory state is projected as a further concatenated input
+        inputs = x if isinstance(x, tuple) else (x,)
+        if memory_state is not None:
+            inputs = inputs + (memory_state,)
+
+        return project_inputs(inputs, self._projection_kernel, bias=self.bias)
+
+    def recurrence_only(self, non_linear_state: torch.FloatTensor, projected_input: torch.FloatTensor) \
+            -> torch.FloatTensor:
         """
+        Recurrence of the non-linear cell on an input already projected by `project`.
 
-        if memory_state is None:
-            # h(t) = (1 - a) * h(t-1) + a * f(Wx * h(t-1) + Wx * x(t) + b)
-            past_state = self._non_linear_state * self._one_minus_leaky_rate
-            self._non_linear_state = past_state.add_(
-                self._non_linear_function(
-                    torch.addmm(self.bias, self._non_linear_state, self.non_linear_kernel)
-                    .addmm_(xt, self.input_non_linear_kernel), out=self._out
-                )
-                .mul_(self._leaky_rate)
-            )
-        else:
-            # h(t) = (1 - a) * h(t-1) + a * f(Wx * h(t-1) + Wm * m(t) + Wx * x(t) + b)
-            past_state = self._non_linear_state * self._one_minus_leaky_rate
-            self._non_linear_state = past_state.add_(
-                self._non_linear_function(
-                    torch.addmm(self.bias, self._non_linear_state, self.non_linear_kernel)
-                    .addmm_(xt, self.input_non_linear_kernel)
-                    .addmm_(memory_state, self.memory_non_linear_kernel), out=self._out
-                )
-                .mul_(self._leaky_rate)
-            )
+        :param non_linear_state: Non-linear state at time t-1.
+        :param projected_input: Projected input at time t.
+        :return: The non-linear state at time t.
+        """
 
-        return self._non_linear_state
+        if self._sparse_recurrent_kernel is not None:
+            activation = sparse_recurrent_input(projected_input, non_linear_state, self._sparse_recurrent_kernel)
+            return self._update_function(non_linear_state, activation, self._step_rate, self._tanh)
+        return self._step_function(non_linear_state, projected_input, self._recurrent_kernel, self._step_rate,
+                                   self._tanh)
 
-    @torch.no_grad()
-    def _forward_euler(self, xt: torch.Tensor, memory_state: torch.FloatTensor | None = None) -> torch.FloatTensor:
+    @torch.inference_mode()
+    def forward(self, xt: torch.Tensor, memory_state: torch.FloatTensor | None = None) -> torch.FloatTensor:
         """
-        Forward pass for the non-linear cell using Euler integration.
+        Forward pass for the non-linear cell.
 
         :param xt: Input tensor at time t.
         :param memory_state: Memory state at time t.
         :return: The non-linear state at time t.
         """
 
-        if memory_state is None:
-            # h(t) = h(t-1) + ε * f(Wx * x(t) + (W - γ * I) * h(t-1) + b)
-            self._non_linear_state += (
-                self._non_linear_function(
-                    torch.addmm(self.bias, self._non_linear_state, self.non_linear_kernel)
-                    .addmm_(xt, self.input_non_linear_kernel), out=self._out
-                )
-                .mul_(self._epsilon)
-            )
-        else:
-            # h(t) = h(t-1) + ε * f(Wx * x(t) + Wm * m(t) + (W - γ * I) * h(t-1) + b)
-            self._non_linear_state += (
-                self._non_linear_function(
-                    torch.addmm(self.bias, self._non_linear_state, self.non_linear_kernel)
-                    .addmm_(xt, self.input_non_linear_kernel)
-                    .addmm_(memory_state, self.memory_non_linear_kernel), out=self._out
-                )
-                .mul_(self._epsilon)
-            )
+        self._non_linear_state = self.recurrence_only(self._non_linear_state, self.project(xt, memory_state))
 
         return self._non_linear_state
 
-    def forward(self, xt: torch.Tensor, memory_state: torch.FloatTensor | None = None) -> torch.FloatTensor:
+    @torch.inference_mode()
+    def forward_sequence(self, x_seq: torch.Tensor | tuple[torch.Tensor, ...],
+                         memory_seq: torch.FloatTensor | None = None,
+                         last_state_only: bool = False, out: torch.FloatTensor | None = None) -> torch.FloatTensor:
+        """
+        Forward pass for the non-linear cell over a whole sequence.
+        The input and memory projections are computed for all the time steps at once, so that just the recurrence
+        is left inside the time loop.
+
+        :param x_seq: Input tensor, or tuple of tensors to be concatenated, of shape
+        (seq_len, batch_size, input_units).
+        :param memory_seq: Memory states of shape (seq_len, batch_size, memory_units).
+        :param last_state_only: Whether to return just the non-linear state at the last time step.
+        :param out: Optional tensor of shape (seq_len, batch_size, non_linear_units) where to store the states.
+        :return: The non-linear states for all the time steps, or just the last one.
         """
-        Forward pass for the non-linear cell using Euler integration.
 
-        :param xt: Input tensor at time t.
-        :param memory_state: Memory state at time t.
-        :return: The non-linear state at time t.
+        projected_input = self.project(x_seq, memory_seq)
+
+        # the non-linear state is updated in place, so that it lives at a fixed address across the calls, as required
+        # by the CUDA graphs replaying this method
+        if self._numpy_kernels is not None:
+            states, non_linear_state = numba_recurrence(
+                projected_input, self._numpy_kernels, self._non_linear_state, self._step_rate, self._euler,
+                self._tanh, last_state_only, out)
+            self._non_linear_state.copy_(non_linear_state)
+            return states
+
+        non_linear_state = self._non_linear_state
+        if last_state_only:
+            for t in range(projected_input.shape[0]):
+                non_linear_state = self.recurrence_only(non_linear_state, projected_input[t])
+            self._non_linear_state.copy_(non_linear_state)
+            return non_linear_state
+
+        states = [None] * projected_input.shape[0]
+        for t in range(projected_input.shape[0]):
+            non_linear_state = self.recurrence_only(non_linear_state, projected_input[t])
+            states[t] = non_linear_state
+        self._non_linear_state.copy_(non_linear_state)
+
+        return torch.stack(states, dim=0, out=out)
+
+    def numpy_kernels(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, bool]:
+        """
+        Non-linear kernel as float32 NumPy arrays for the Numba recurrence, in CSR format if it is sparse.
+
+        :return: The non-linear kernel as returned by `numpy_kernels`.
         """
 
-        return self._forward_function(xt, memory_state)
+        return numpy_kernels(self.non_linear_kernel.detach().cpu().numpy())
 
-    def reset_state(self, batch_size: int, device: torch.device) -> None:
+    def reset_state(self, batch_size: int, device: torch.device, numba: bool = False) -> None:
         """
         Reset the non-linear state.
 
         :param batch_size: The batch size.
         :param device: The device to use.
+        :param numba: Whether to run the recurrence with the compiled Numba kernel. Requires a CPU device and
+        float32 compute dtype.
         """
 
-        self._epsilon = self._epsilon.to(device)
-        self._leaky_rate = self._leaky_rate.to(device)
-        self._one_minus_leaky_rate = self._one_minus_leaky_rate.to(device)
         self._non_linear_state = torch.zeros((batch_size, self.non_linear_kernel.shape[0]), dtype=torch.float32,
                                              device=device, requires_grad=False)
-        self._out = torch.empty_like(self._non_linear_state, device=device, dtype=torch.float32, requires_grad=False)
+        self._projection_kernel = torch.cat([self.input_non_linear_kernel, self.memory_non_linear_kernel]) \
+            .to(self._compute_dtype)
+        self._recurrent_kernel = self.non_linear_kernel.to(self._compute_dtype)
+        # sparse products are only used in float32, low precision sparse kernels are poorly supported
+        self._sparse_recurrent_kernel = sparsify_kernel(self.non_linear_kernel) \
+            if self._compute_dtype == torch.float32 else None
+        self._numpy_kernels = self.numpy_kernels() if numba else None